@@ -1,8 +1,13 @@
 import os
 import time
 import glob
-import requests
+import asyncio
+import aiohttp
+import random
+import shelve
 import tarfile
+import threading
+import concurrent.futures
 import io
 
 # Define input and output directories
@@ -10,9 +15,36 @@ QUERY_DIR = "/home4/2948645s/chai_project/Work/monkeypox/mpox_best_models_pdb"
 OUT_DIR = "/home4/2948645s/chai_project/Work/monkeypox/foldseek_results"
 os.makedirs(OUT_DIR, exist_ok=True)
 
+# Persistent {pdb_path: ticket} map so interrupted runs re-poll instead of resubmitting
+TICKET_CACHE = "foldseek_tickets.db"
+# Written into a result folder once its archive has been fully extracted
+DONE_MARKER = ".done"
+
+# Ticket statuses that mean the job is still queued or running on the server
+ACTIVE_STATUSES = {"PENDING", "RUNNING"}
+
 # Set polling timeout and retry limit
 MAX_WAIT = 180  # max waiting time in seconds
-NO_PROGRESS_LIMIT = 5  # stop if no status change after 5 polls
+NO_PROGRESS_TIMEOUT = 120  # stop if the status has not changed for this many seconds
+
+# Exponential backoff between status polls (seconds)
+POLL_INITIAL_DELAY = 1.0
+POLL_MAX_DELAY = 32.0
+
+# Number of structures submitted and polled concurrently
+MAX_CONCURRENT_JOBS = 8
+
+# Keep-alive connection pool shared by all requests, and per-request timeouts
+POOL_SIZE = 32
+KEEPALIVE_TIMEOUT = 60  # seconds an idle connection is kept; longer than POLL_MAX_DELAY so slow polls reuse it
+CONNECT_TIMEOUT = 10  # seconds to establish a connection
+READ_TIMEOUT = 120  # seconds to wait for data on an open connection
+
+# Retry transient network errors and gateway responses with jittered backoff
+MAX_RETRIES = 5
+RETRY_BACKOFF = 0.5  # base delay in seconds, doubled on each attempt
+RETRY_MAX_DELAY = 32  # upper bound in seconds on a server-requested Retry-After
+RETRY_STATUSES = {502, 503, 504}
 
 # List of FoldSeek databases to search
 FOLDSEEK_DATABASES = [
@@ -25,54 +57,174 @@ FOLDSEEK_DATABASES = [
     "gmgcl_id"
 ]
 
-def submit_foldseek(file_path):
+async def request_with_retry(send):
+    """Await send() until it returns a non-transient response, backing off between tries."""
+    for attempt in range(MAX_RETRIES + 1):
+        delay = random.uniform(0, RETRY_BACKOFF * 2 ** attempt)
+        try:
+            response = await send()
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            if attempt == MAX_RETRIES:
+                raise
+        else:
+            if response.status not in RETRY_STATUSES or attempt == MAX_RETRIES:
+                return response
+            retry_after = response.headers.get("Retry-After", "")
+            if retry_after.isdigit():
+                # Bounded so a huge Retry-After cannot hold a job slot for long
+                delay = min(int(retry_after), RETRY_MAX_DELAY)
+            response.release()
+        await asyncio.sleep(delay)
+
+async def submit_foldseek(session, file_path):
     """Submit a PDB structure to FoldSeek API and return the ticket info."""
     url = "https://search.foldseek.com/api/ticket"
     with open(file_path, "rb") as f:
-        files = { "q": (os.path.basename(file_path), f, "application/octet-stream") }
-        data = [("mode", "3diaa")] + [("database[]", db) for db in FOLDSEEK_DATABASES]
-        res = requests.post(url, files=files, data=data)
+        pdb_bytes = f.read()
+
+    def build_form():
+        # A FormData can only be sent once, so build a fresh one per attempt
+        form = aiohttp.FormData()
+        form.add_field("q", pdb_bytes, filename=os.path.basename(file_path),
+                       content_type="application/octet-stream")
+        form.add_field("mode", "3diaa")
+        for db in FOLDSEEK_DATABASES:
+            form.add_field("database[]", db)
+        return form
+
+    async with await request_with_retry(lambda: session.post(url, data=build_form())) as res:
         res.raise_for_status()
-        return res.json()
+        return await res.json()
 
-def poll_until_ready(ticket, file_path):
+async def poll_until_ready(session, ticket, file_path):
     """Poll FoldSeek server until the job is complete, or raise error/timeout."""
     url = f"https://search.foldseek.com/api/ticket/{ticket}"
     start = time.time()
     last_status = ""
-    same_count = 0
+    last_change = start
+    delay = POLL_INITIAL_DELAY
 
     while True:
-        time.sleep(5)
-        r = requests.get(url)
-        r.raise_for_status()
-        info = r.json()
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, POLL_MAX_DELAY)
+        async with await request_with_retry(lambda: session.get(url)) as r:
+            r.raise_for_status()
+            info = await r.json()
         status = info["status"]
 
         if status == "COMPLETE":
             return f"https://search.foldseek.com/api/result/download/{ticket}"
         elif status == "ERROR":
             raise RuntimeError(f"Server returned error for {file_path}: {info}")
+        elif status not in ACTIVE_STATUSES:
+            raise RuntimeError(f"Unexpected status {status} for {file_path}, ticket {ticket}")
         elif time.time() - start > MAX_WAIT:
             raise TimeoutError(f"Timeout while waiting for {file_path}")
         elif status == last_status:
-            same_count += 1
-            if same_count >= NO_PROGRESS_LIMIT:
-                raise RuntimeError(f"No progress for {file_path}, ticket {ticket}")
+            if time.time() - last_change > NO_PROGRESS_TIMEOUT:
+                raise TimeoutError(f"No progress for {file_path}, ticket {ticket}")
         else:
-            same_count = 0
             last_status = status
+            last_change = time.time()
+            delay = POLL_INITIAL_DELAY
+
+class ResponseStream(io.RawIOBase):
+    """Blocking file object that reads an aiohttp response body from a worker thread."""
+
+    POLL_INTERVAL = 0.5  # seconds between checks for cancellation while a read is pending
+
+    def __init__(self, content, loop):
+        self.content = content
+        self.loop = loop
+        self.stopped = threading.Event()
+
+    def readable(self):
+        return True
+
+    def stop(self):
+        """Make any pending or future read fail so the worker thread can exit."""
+        self.stopped.set()
 
-def download_and_extract(result_url, out_dir, file_path):
+    def readinto(self, buffer):
+        future = asyncio.run_coroutine_threadsafe(self.content.read(len(buffer)), self.loop)
+        while True:
+            try:
+                data = future.result(timeout=self.POLL_INTERVAL)
+                break
+            except concurrent.futures.TimeoutError:
+                if self.stopped.is_set():
+                    future.cancel()
+                    raise OSError("Download cancelled")
+        buffer[:len(data)] = data
+        return len(data)
+
+def skip_unsafe_member(member, dest_path):
+    """Tar extraction filter that drops members the "data" filter rejects."""
+    try:
+        return tarfile.data_filter(member, dest_path)
+    except tarfile.FilterError as e:
+        print(f"Skipping unsafe archive member {member.name}: {e}")
+        return None
+
+def extract_stream(fileobj, out_dir):
+    """Extract a tar archive from a non-seekable stream, skipping unsafe members."""
+    with tarfile.open(fileobj=fileobj, mode="r|*") as tar:
+        if hasattr(tarfile, "data_filter"):
+            tar.extractall(out_dir, filter=skip_unsafe_member)
+        else:
+            tar.extractall(out_dir)
+
+async def download_and_extract(session, result_url, out_dir, file_path):
     """Download and extract FoldSeek result archive to the specified folder."""
-    r = requests.get(result_url)
-    r.raise_for_status()
     os.makedirs(out_dir, exist_ok=True)
-    with tarfile.open(fileobj=io.BytesIO(r.content)) as tar:
-        tar.extractall(out_dir)
+    async with await request_with_retry(lambda: session.get(result_url)) as r:
+        r.raise_for_status()
+        # Extract in a worker thread while the body is still downloading
+        raw = ResponseStream(r.content, asyncio.get_running_loop())
+        try:
+            await asyncio.to_thread(extract_stream, io.BufferedReader(raw), out_dir)
+        except asyncio.CancelledError:
+            raw.stop()
+            raise
     print(f"Saved to {out_dir}\n")
 
-def process_structure(pdb_path):
+async def fetch_results(session, ticket, result_folder, pdb_path):
+    """Wait for a FoldSeek ticket to finish and extract its results."""
+    result_url = await poll_until_ready(session, ticket, pdb_path)
+    print(f"Download from: {result_url}")
+    await download_and_extract(session, result_url, result_folder, pdb_path)
+
+async def run_foldseek_job(session, cache, pdb_path, result_folder):
+    """Fetch results for a PDB file, reusing a cached ticket when possible."""
+    ticket = cache.get(pdb_path)
+    if ticket:
+        print(f"\nResuming {pdb_path} | Ticket: {ticket}")
+        # Only a rejected or expired ticket, or a server-side job error, is worth
+        # resubmitting; timeouts leave the ticket cached so the next run can poll it again
+        try:
+            return await fetch_results(session, ticket, result_folder, pdb_path)
+        except aiohttp.ClientResponseError as e:
+            if not 400 <= e.status < 500:
+                raise
+            reason = e
+        except RuntimeError as e:
+            reason = e
+        print(f"Cached ticket {ticket} unusable ({reason}), resubmitting")
+        del cache[pdb_path]
+        cache.sync()
+
+    print(f"\nSubmitting {pdb_path}")
+    res_json = await submit_foldseek(session, pdb_path)
+    ticket = res_json.get("ticket") or res_json.get("id")
+    if not ticket:
+        raise ValueError(f"No ticket returned: {res_json}")
+    cache[pdb_path] = ticket
+    cache.sync()
+
+    print(f"Ticket: {ticket} | Status: {res_json.get('status')}")
+    await fetch_results(session, ticket, result_folder, pdb_path)
+
+async def process_structure(session, semaphore, cache, pdb_path):
     """Submit a PDB file to FoldSeek and process the returned results."""
     if not pdb_path.endswith(".pdb"):
         print(f"Skipping non-pdb file: {pdb_path}")
@@ -80,30 +232,40 @@ def process_structure(pdb_path):
 
     uniprot = os.path.basename(pdb_path).replace(".pdb", "")
     result_folder = os.path.join(OUT_DIR, uniprot)
-    if os.path.exists(os.path.join(result_folder, "aln.tsv")):
+    # Folders from runs before DONE_MARKER existed are complete if they hold aln.tsv,
+    # unless a cached ticket shows the extraction was interrupted by this version
+    legacy_done = (os.path.exists(os.path.join(result_folder, "aln.tsv"))
+                   and pdb_path not in cache)
+    if os.path.exists(os.path.join(result_folder, DONE_MARKER)) or legacy_done:
         print(f"Skipping {uniprot} (already done)")
         return
 
-    try:
-        print(f"\nSubmitting {pdb_path}")
-        res_json = submit_foldseek(pdb_path)
-        ticket = res_json.get("ticket") or res_json.get("id")
-        if not ticket:
-            raise ValueError(f"No ticket returned: {res_json}")
-
-        print(f"Ticket: {ticket} | Status: {res_json.get('status')}")
-        result_url = poll_until_ready(ticket, pdb_path)
-        print(f"Download from: {result_url}")
-        download_and_extract(result_url, result_folder, pdb_path)
-        time.sleep(10)  # slight delay to avoid overloading the server
-    except Exception as e:
-        print(f" Error: {e}")
-        with open("foldseek_failures.txt", "a") as f:
-            f.write(f"{pdb_path}\n")
+    async with semaphore:
+        try:
+            await run_foldseek_job(session, cache, pdb_path, result_folder)
+            with open(os.path.join(result_folder, DONE_MARKER), "w"):
+                pass
+            del cache[pdb_path]
+            cache.sync()
+        except Exception as e:
+            print(f" Error: {e}")
+            with open("foldseek_failures.txt", "a") as f:
+                f.write(f"{pdb_path}\n")
 
-if __name__ == "__main__":
+async def main():
     # Find all PDB files in the input directory
     all_pdbs = sorted(glob.glob(os.path.join(QUERY_DIR, "*.pdb")))
     print(f"\nFound {len(all_pdbs)} PDB files.\n")
-    for path in all_pdbs:
-        process_structure(path)
+
+    # Cap the number of jobs in flight to avoid overloading the server
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_JOBS)
+    connector = aiohttp.TCPConnector(limit=POOL_SIZE, limit_per_host=POOL_SIZE,
+                                     keepalive_timeout=KEEPALIVE_TIMEOUT)
+    timeout = aiohttp.ClientTimeout(sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT)
+    with shelve.open(TICKET_CACHE) as cache:
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            tasks = [process_structure(session, semaphore, cache, p) for p in all_pdbs]
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+if __name__ == "__main__":
+    asyncio.run(main())